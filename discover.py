@@ -9,13 +9,15 @@ class Discover:
         self.tests = []
 
     def flatten_results(self, iterable):
-        input = list(iterable)
-        while input:
-            item = input.pop(0)
-            try:
-                data = iter(item)
-                input = list(data) + input
-            except:
+        # Walk the suites depth-first with an explicit stack, kept in
+        # reverse so that tests come out in their original order.
+        stack = list(iterable)
+        stack.reverse()
+        while stack:
+            item = stack.pop()
+            if isinstance(item, unittest.BaseTestSuite):
+                stack.extend(reversed(list(item)))
+            else:
                 yield item
 
     def collect_tests(self, dirname):
@@ -3,13 +3,36 @@
 @brief This file contains the implementation of generic UI event structures.
 """
 
+from collections import defaultdict
+
 # Generic UI events structure
 
 class EventSource(object):
     """
     @brief Generate GUI events.
     """
-    _events = {}
+    # No per-instance state; lets subclasses use __slots__.
+    __slots__ = ()
+
+    # Handlers bound to this class, as {event: [handler, ...]}.
+    _handlers = defaultdict(list)
+
+    # The dispatch table used by emit(), derived from _handlers: holds
+    # {event: handler} for events with a single handler, or
+    # {event: (handler, ...)} for events with several.
+    # Every subclass gets its own tables, so handlers are only called for
+    # the exact class they were bound to.
+    _event_table = {}
+
+    # While suspended, emitted events are queued on _pending as
+    # (source, event, data) tuples instead of being dispatched.
+    _suspended = False
+    _pending = []
+
+    def __init_subclass__(cls, **kwargs):
+        super(EventSource, cls).__init_subclass__(**kwargs)
+        cls._handlers = defaultdict(list)
+        cls._event_table = {}
 
     @classmethod
     def bind(cls, event, handler):
@@ -19,7 +42,28 @@ class EventSource(object):
         @param event The event to bind.
         @param handler The handler function to call when the event is emitted.
         """
-        cls._events.setdefault(cls, {}).setdefault(event, []).append(handler)
+        handlers = cls._handlers[event]
+        handlers.append(handler)
+        cls._event_table[event] = handlers[0] if len(handlers) == 1 else tuple(handlers)
+
+    @staticmethod
+    def suspend():
+        """
+        @brief Stop dispatching events; queue them instead.
+        """
+        EventSource._suspended = True
+
+    @staticmethod
+    def resume():
+        """
+        @brief Resume dispatching events.
+
+        @return The list of (source, event, data) tuples queued while suspended.
+        """
+        pending = EventSource._pending
+        EventSource._pending = []
+        EventSource._suspended = False
+        return pending
 
     def emit(self, event, **data):
         """
@@ -28,9 +72,16 @@ class EventSource(object):
         @param event The event to emit.
         @param data Additional data to pass to the handler functions.
         """
-        try:
-            for handler in self._events[self.__class__][event]:
-                handler(self, **data)
-        except KeyError:
+        if EventSource._suspended:
+            EventSource._pending.append((self, event, data))
+            return
+
+        handlers = type(self)._event_table.get(event)
+        if handlers is None:
             # No handler registered for event.
-            pass
+            return
+        if type(handlers) is tuple:
+            for handler in handlers:
+                handler(self, **data)
+        else:
+            handlers(self, **data)
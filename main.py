@@ -4,15 +4,10 @@
 
 This module serves as the entry point for the pytest-gui application.
 It handles the initialization of the GUI window and project loading.
-The module provides compatibility with both Python 2 (Tkinter) and Python 3 (tkinter).
+The GUI modules are only imported when the main loop is started, so that
+importing this module doesn't load Tk.
 """
 
-try:
-    from Tkinter import *  #!< Python 2.x Tkinter import
-except ImportError:
-    from tkinter import *  #!< Python 3.x tkinter import
-
-from view import MainWindow
 from model import UnittestProject
 
 
@@ -40,6 +35,9 @@ def main_loop(Model=UnittestProject):
     main_loop()  # Run with default UnittestProject model
     @endcode
     """
+    from tkinter import Tk
+    from view import MainWindow
+
     # Set up the root Tk context
     root = Tk()
 
@@ -6,7 +6,8 @@ methods, and test hierarchies in a GUI-based test runner. It includes classes fo
 test statuses, active states, and test discovery.
 """
 
-from datetime import datetime
+from collections import namedtuple
+from contextlib import contextmanager
 from events import EventSource
 import sys
 
@@ -25,6 +26,29 @@ class ModelLoadError(Exception):
         self.trace = trace
 
 
+## The outcome of a single test method execution
+Result = namedtuple('Result', 'status output error duration description')
+
+## Key marking a label trie node that is itself a complete label
+LABEL_END = None
+
+
+def label_trie(labels):
+    """! Build a prefix tree out of dotted test labels
+    @param labels Collection of dotted test labels
+    @return Nested dicts keyed by path component. A node that contains
+            LABEL_END corresponds to a complete label.
+    """
+    trie = {}
+    for label in labels:
+        node = trie
+        # Test cases at the top level have a path with a leading '.'
+        for part in label.lstrip('.').split('.'):
+            node = node.setdefault(part, {})
+        node[LABEL_END] = True
+    return trie
+
+
 class TestMethod(EventSource):
     """! Represents a single test method within a test case.
     
@@ -32,7 +56,8 @@ class TestMethod(EventSource):
              results, and active state. It inherits from EventSource to provide event
              notification capabilities.
     """
-    
+    __slots__ = ('name', '_active', '_result', 'parent', 'generation', '_path')
+
     ## Status code for passed tests
     STATUS_PASS = 100
     ## Status code for skipped tests
@@ -64,14 +89,14 @@ class TestMethod(EventSource):
         @param testCase The parent TestCase instance
         """
         self.name = name
-        self.description = ''
         self._active = True
         self._result = None
 
         # Set the parent of the TestMethod
         self.parent = testCase
+        self._path = u'%s.%s' % (testCase.path, name)
         self.parent[name] = self
-        self.parent._update_active()
+        self.parent._child_active_changed(1)
 
         # Announce that there is a new test method
         self.emit('new')
@@ -87,7 +112,7 @@ class TestMethod(EventSource):
         """! Get the full dotted path name of the test method
         @return String containing the full path
         """
-        return u'%s.%s' % (self.parent.path, self.name)
+        return self._path
 
     @property
     def active(self):
@@ -105,14 +130,12 @@ class TestMethod(EventSource):
             if not is_active:
                 self._active = False
                 self.emit('inactive')
-                if cascade:
-                    self.parent._update_active()
+                self.parent._child_active_changed(-1, cascade)
         else:
             if is_active:
                 self._active = True
                 self.emit('active')
-                if cascade:
-                    self.parent._update_active()
+                self.parent._child_active_changed(1, cascade)
 
     def toggle_active(self):
         """! Toggle the active state of the test method
@@ -124,54 +147,45 @@ class TestMethod(EventSource):
         """! Get the current status of the test method
         @return Status code or None if no result available
         """
-        try:
-            return self._result['status']
-        except TypeError:
-            return None
+        return None if self._result is None else self._result.status
 
     @property
     def output(self):
         """! Get the test output
         @return Test output string or None if no result available
         """
-        try:
-            return self._result['output']
-        except TypeError:
-            return None
+        return None if self._result is None else self._result.output
 
     @property
     def error(self):
         """! Get the test error information
         @return Error details or None if no error occurred
         """
-        try:
-            return self._result['error']
-        except TypeError:
-            return None
+        return None if self._result is None else self._result.error
 
     @property
     def duration(self):
         """! Get the test execution duration
         @return Duration in seconds or None if not available
         """
-        try:
-            return self._result['duration']
-        except TypeError:
-            return None
+        return None if self._result is None else self._result.duration
+
+    @property
+    def description(self):
+        """! Get the test description
+        @return Description string, or an empty string if the test hasn't run
+        """
+        return '' if self._result is None else self._result.description
 
-    def set_result(self, status, output, error, duration):
+    def set_result(self, status, output, error, duration, description=''):
         """! Set the test result information
         @param status The status code of the test execution
         @param output The output generated during test execution
         @param error Any error information if the test failed
         @param duration The time taken to execute the test
+        @param description The test description reported by the runner
         """
-        self._result = {
-            'status': status,
-            'output': output,
-            'error': error,
-            'duration': duration,
-        }
+        self._result = Result(status, output, error, duration, description)
         self.emit('status_update')
 
 
@@ -181,6 +195,7 @@ class TestCase(dict, EventSource):
     @details A TestCase is a collection of related test methods, managing their
              organization and execution state. Inherits from both dict and EventSource.
     """
+    __slots__ = ('name', '_active', '_active_count', 'parent', '_path')
 
     def __init__(self, name, testApp):
         """! Initialize a new test case
@@ -190,11 +205,14 @@ class TestCase(dict, EventSource):
         super(TestCase, self).__init__()
         self.name = name
         self._active = True
+        # Number of child test methods that are currently active
+        self._active_count = 0
 
         # Set the parent of the TestCase
         self.parent = testApp
+        self._path = u'%s.%s' % (testApp.path, name)
         self.parent[name] = self
-        self.parent._update_active()
+        self.parent._child_active_changed(1)
 
         # Announce that there is a new TestCase
         self.emit('new')
@@ -210,7 +228,7 @@ class TestCase(dict, EventSource):
         """! Get the full dotted path name of the test case
         @return String containing the full path
         """
-        return u'%s.%s' % (self.parent.path, self.name)
+        return self._path
 
     @property
     def active(self):
@@ -228,19 +246,27 @@ class TestCase(dict, EventSource):
             if not is_active:
                 self._active = False
                 self.emit('inactive')
-                if cascade:
-                    self.parent._update_active()
-                for testMethod in self.values():
-                    testMethod.set_active(False, cascade=False)
+                self.parent._child_active_changed(-1, cascade)
+                self._force_inactive_all()
         else:
             if is_active:
                 self._active = True
                 self.emit('active')
-                if cascade:
-                    self.parent._update_active()
+                self.parent._child_active_changed(1, cascade)
                 for testMethod in self.values():
                     testMethod.set_active(True, cascade=False)
 
+    def _force_inactive_all(self):
+        """! Make every test method in this case inactive
+        @details Only used once this case is itself inactive, so the methods
+                 can be flipped directly without reporting back to the case.
+        """
+        for testMethod in self.values():
+            if testMethod._active:
+                testMethod._active = False
+                testMethod.emit('inactive')
+        self._active_count = 0
+
     def toggle_active(self):
         """! Toggle the active state of the test case
         """
@@ -250,19 +276,19 @@ class TestCase(dict, EventSource):
         """! Find test methods matching specified criteria
         @param active Only include active tests if True
         @param status List of status codes to filter by
-        @param labels List of test labels to filter by
+        @param labels Label trie node for this test case (see label_trie)
         @return Tuple of (count, test_paths) where test_paths is either a list or single path
         """
         tests = []
         count = 0
 
-        for testMethod_name, testMethod in self.items():
+        for testMethod in self.values():
             include = True
             if active and not testMethod.active:
                 include = False
             if status and testMethod.status not in status:
                 include = False
-            if labels and testMethod.path not in labels:
+            if labels and testMethod.name not in labels:
                 include = False
 
             if include:
@@ -274,22 +300,24 @@ class TestCase(dict, EventSource):
 
         return count, tests
 
-    def _purge(self, timestamp):
-        """! Remove test methods that aren't current as of the timestamp
-        @param timestamp Datetime object to compare against
+    def _purge(self, generation):
+        """! Remove test methods that weren't seen in the given refresh
+        @param generation Refresh generation number to compare against
         """
-        for testMethod_name, testMethod in self.items():
-            if testMethod.timestamp != timestamp:
-                self.pop(testMethod_name)
+        for testMethod_name, testMethod in list(self.items()):
+            if testMethod.generation != generation:
+                del self[testMethod_name]
+                if testMethod.active:
+                    self._active_count -= 1
 
-    def _update_active(self):
-        """! Update this node's active status based on children's status
+    def _child_active_changed(self, delta, cascade=True):
+        """! Record a change in the number of active children
+        @param delta +1 if a child became active, -1 if it became inactive
+        @param cascade Whether to update this node's active state to match
         """
-        for testMethod_name, testMethod in self.items():
-            if testMethod.active:
-                self.set_active(True)
-                return
-        self.set_active(False)
+        self._active_count += delta
+        if cascade and (self._active_count > 0) != self._active:
+            self.set_active(self._active_count > 0)
 
 
 class TestModule(dict, EventSource):
@@ -298,6 +326,7 @@ class TestModule(dict, EventSource):
     @details A TestModule is a collection of related test cases, providing organizational
              structure and state management. Inherits from both dict and EventSource.
     """
+    __slots__ = ('name', '_active', '_active_count', 'parent', '_path')
 
     def __init__(self, name, parent):
         """! Initialize a new test module
@@ -307,9 +336,18 @@ class TestModule(dict, EventSource):
         super(TestModule, self).__init__()
         self.name = name
         self._active = True
+        # Number of child modules/cases that are currently active
+        self._active_count = 0
 
         self.parent = parent
+        if parent.path:
+            self._path = u'%s.%s' % (parent.path, name)
+        else:
+            self._path = name
         self.parent[name] = self
+        # Count the new module, but don't reactivate a parent module the
+        # user has deactivated; only new cases and methods do that.
+        self.parent._child_active_changed(1, cascade=False)
 
         self.emit('new')
 
@@ -324,9 +362,7 @@ class TestModule(dict, EventSource):
         """! Get the full dotted path name of the test module
         @return String containing the full path
         """
-        if self.parent.path:
-            return u'%s.%s' % (self.parent.path, self.name)
-        return self.name
+        return self._path
 
     @property
     def active(self):
@@ -344,19 +380,28 @@ class TestModule(dict, EventSource):
             if not is_active:
                 self._active = False
                 self.emit('inactive')
-                if cascade:
-                    self.parent._update_active()
-                for testModule in self.values():
-                    testModule.set_active(False, cascade=False)
+                self.parent._child_active_changed(-1, cascade)
+                self._force_inactive_all()
         else:
             if is_active:
                 self._active = True
                 self.emit('active')
-                if cascade:
-                    self.parent._update_active()
+                self.parent._child_active_changed(1, cascade)
                 for testModule in self.values():
                     testModule.set_active(True, cascade=False)
 
+    def _force_inactive_all(self):
+        """! Make everything under this module inactive
+        @details Only used once this module is itself inactive, so the children
+                 can be flipped directly without reporting back to the module.
+        """
+        for testModule in self.values():
+            if testModule._active:
+                testModule._active = False
+                testModule.emit('inactive')
+                testModule._force_inactive_all()
+        self._active_count = 0
+
     def toggle_active(self):
         """! Toggle the active state of the test module
         """
@@ -366,23 +411,27 @@ class TestModule(dict, EventSource):
         """! Find test methods in this module matching specified criteria
         @param active Only include active tests if True
         @param status List of status codes to filter by
-        @param labels List of test labels to filter by
+        @param labels Label trie node for this module (see label_trie)
         @return Tuple of (count, test_paths) where test_paths is either a list or single path
         """
         tests = []
         count = 0
         found_partial = False
 
-        for testModule_name, testModule in self.items():
+        for testModule in self.values():
             include = True
             if active and not testModule.active:
                 include = False
 
             if labels:
-                if testModule.path in labels:
+                sublabels = labels.get(testModule.name)
+                if sublabels is None:
+                    # No label selects anything in this subtree.
+                    subcount, subtests = 0, []
+                elif LABEL_END in sublabels:
                     subcount, subtests = testModule.find_tests(True, status)
                 else:
-                    subcount, subtests = testModule.find_tests(active, status, labels)
+                    subcount, subtests = testModule.find_tests(active, status, sublabels)
             else:
                 subcount, subtests = testModule.find_tests(active, status)
 
@@ -393,29 +442,34 @@ class TestModule(dict, EventSource):
                     tests.extend(subtests)
                 else:
                     tests.append(subtests)
+            else:
+                # An excluded child means this node can't be run as a whole.
+                found_partial = True
 
         if not found_partial:
             return count, self.path
 
         return count, tests
 
-    def _purge(self, timestamp):
-        """! Remove test modules that aren't current as of the timestamp
-        @param timestamp Datetime object to compare against
+    def _purge(self, generation):
+        """! Remove test modules that weren't seen in the given refresh
+        @param generation Refresh generation number to compare against
         """
-        for testModule_name, testModule in self.items():
-            testModule._purge(timestamp)
+        for testModule_name, testModule in list(self.items()):
+            testModule._purge(generation)
             if len(testModule) == 0:
-                self.pop(testModule_name)
+                del self[testModule_name]
+                if testModule.active:
+                    self._active_count -= 1
 
-    def _update_active(self):
-        """! Update this node's active status based on children's status
+    def _child_active_changed(self, delta, cascade=True):
+        """! Record a change in the number of active children
+        @param delta +1 if a child became active, -1 if it became inactive
+        @param cascade Whether to update this node's active state to match
         """
-        for subModule_name, subModule in self.items():
-            if subModule.active:
-                self.set_active(True)
-                return
-        self.set_active(False)
+        self._active_count += delta
+        if cascade and (self._active_count > 0) != self._active:
+            self.set_active(self._active_count > 0)
 
 
 class Project(dict, EventSource):
@@ -425,12 +479,15 @@ class Project(dict, EventSource):
              cases, and methods. It provides project-wide operations and state management.
              Inherits from both dict and EventSource.
     """
+    __slots__ = ('errors', '_generation')
 
     def __init__(self):
         """! Initialize a new project
         """
         super(Project, self).__init__()
         self.errors = []
+        # Incremented on every refresh, to tell current tests from stale ones
+        self._generation = 0
 
     def __repr__(self):
         """! String representation of the project
@@ -449,23 +506,32 @@ class Project(dict, EventSource):
         """! Find all test methods in the project matching specified criteria
         @param active Only include active tests if True
         @param status List of status codes to filter by
-        @param labels List of test labels to filter by
+        @param labels Collection of test labels to filter by
         @return Tuple of (count, test_paths) where test_paths is a list of matching tests
         """
+        # Walk the labels down the tree alongside the modules, so subtrees
+        # that no label points into are never visited.
+        if labels:
+            labels = label_trie(labels)
+
         tests = []
         count = 0
         found_partial = False
 
-        for testApp_name, testApp in self.items():
+        for testApp in self.values():
             include = True
             if active and not testApp.active:
                 include = False
 
             if labels:
-                if testApp.path in labels:
+                sublabels = labels.get(testApp.name)
+                if sublabels is None:
+                    # No label selects anything in this subtree.
+                    subcount, subtests = 0, []
+                elif LABEL_END in sublabels:
                     subcount, subtests = testApp.find_tests(True, status)
                 else:
-                    subcount, subtests = testApp.find_tests(active, status, labels)
+                    subcount, subtests = testApp.find_tests(active, status, sublabels)
             else:
                 subcount, subtests = testApp.find_tests(active, status)
 
@@ -476,40 +542,74 @@ class Project(dict, EventSource):
                     tests.extend(subtests)
                 else:
                     tests.append(subtests)
+            else:
+                # An excluded child means this node can't be run as a whole.
+                found_partial = True
 
         if not found_partial:
             return count, []
         return count, tests
 
-    def confirm_exists(self, test_label, timestamp=None):
+    @contextmanager
+    def batch(self):
+        """! Suspend event dispatch while the test hierarchy is updated in bulk
+        @details Events emitted inside the block are not dispatched one by one.
+                 When the outermost block exits, the project emits a single
+                 'bulk_update' event, whose `events` argument is the list of
+                 (source, event, data) tuples that were held back.
+        """
+        if EventSource._suspended:
+            # Nested batch; the outermost one reports.
+            yield
+            return
+
+        EventSource.suspend()
+        try:
+            yield
+        finally:
+            events = EventSource.resume()
+        self.emit('bulk_update', events=events)
+
+    def confirm_exists(self, test_label, generation=None, cache=None):
         """! Ensure a test exists in the project hierarchy
         @param test_label The full dotted path of the test
-        @param timestamp Optional timestamp for tracking test currency
+        @param generation Optional refresh generation for tracking test currency
+        @param cache Optional dict mapping tuples of module names to the modules
+                     already resolved for them. Pass the same dict to a series
+                     of calls so that shared module prefixes are only walked once.
         @return The created or existing TestMethod instance
         """
         parts = test_label.split('.')
         if len(parts) < 2:
             return
 
+        module_parts = tuple(parts[:-2])
         parentModule = self
-        for testModule_name in parts[:-2]:
-            try:
-                testModule = parentModule[testModule_name]
-            except KeyError:
+        resolved = 0
+        if cache is not None:
+            # Start from the longest module prefix that is already resolved.
+            for resolved in range(len(module_parts), 0, -1):
+                if (cached := cache.get(module_parts[:resolved])) is not None:
+                    parentModule = cached
+                    break
+            else:
+                resolved = 0
+
+        for depth in range(resolved, len(module_parts)):
+            testModule_name = module_parts[depth]
+            if (testModule := parentModule.get(testModule_name)) is None:
                 testModule = TestModule(testModule_name, parentModule)
+            if cache is not None:
+                cache[module_parts[:depth + 1]] = testModule
             parentModule = testModule
 
-        try:
-            testCase = parentModule[parts[-2]]
-        except KeyError:
+        if (testCase := parentModule.get(parts[-2])) is None:
             testCase = TestCase(parts[-2], parentModule)
 
-        try:
-            testMethod = testCase[parts[-1]]
-        except KeyError:
+        if (testMethod := testCase.get(parts[-1])) is None:
             testMethod = TestMethod(parts[-1], testCase)
 
-        testMethod.timestamp = timestamp
+        testMethod.generation = generation
         return testMethod
 
     def refresh(self, test_list, errors=None):
@@ -517,19 +617,26 @@ class Project(dict, EventSource):
         @param test_list List of test labels to include
         @param errors Optional list of errors encountered during refresh
         """
-        timestamp = datetime.now()
+        self._generation += 1
+        generation = self._generation
 
-        for test_label in test_list:
-            self.confirm_exists(test_label, timestamp)
+        # Tree widgets are rebuilt from the project after a refresh, so
+        # there's no need to announce every node as it's created.
+        with self.batch():
+            # Tests in the same module share a module prefix; only resolve
+            # each prefix once.
+            cache = {}
+            for test_label in test_list:
+                self.confirm_exists(test_label, generation, cache)
 
-        for testModule_name, testModule in self.items():
-            testModule._purge(timestamp)
-            if len(testModule) == 0:
-                self.pop(testModule_name)
+            for testModule_name, testModule in list(self.items()):
+                testModule._purge(generation)
+                if len(testModule) == 0:
+                    del self[testModule_name]
 
         self.errors = errors if errors is not None else []
 
-    def _update_active(self):
+    def _child_active_changed(self, delta, cascade=True):
         """! Placeholder method for API consistency
         """
         pass
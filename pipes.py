@@ -5,22 +5,158 @@
 
 from __future__ import absolute_import
 
+import io
 import json
-try:
-    from StringIO import StringIO
-except ImportError:
-    from io import StringIO
 import sys
 import time
 import traceback
 
 import unittest
 
+# The codec for result records. Use orjson or ujson when one is installed,
+# as they are much faster than the stdlib json module; all of them produce
+# compact, single-line output. dumpb() returns the record as UTF-8 bytes.
+#
+# The faster codecs refuse strings holding lone surrogates (such as file
+# names that couldn't be decoded, which tests may well print), both when
+# encoding and when decoding the escapes json writes for them; those
+# records go through the stdlib json module instead.
+
+# json.dumps() builds a new encoder on every call when given any options,
+# so make one up front. Records never contain cycles.
+_json_encode = json.JSONEncoder(separators=(',', ':'), check_circular=False).encode
+
+try:
+    import orjson
+
+    def dumpb(obj):
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            return _json_encode(obj).encode('utf-8')
+
+    def loads(s):
+        try:
+            return orjson.loads(s)
+        except ValueError:
+            return json.loads(s)
+except ImportError:
+    try:
+        import ujson
+
+        def dumpb(obj):
+            try:
+                return ujson.dumps(obj).encode('utf-8')
+            except (TypeError, ValueError):
+                return _json_encode(obj).encode('utf-8')
+
+        def loads(s):
+            try:
+                return ujson.loads(s)
+            except ValueError:
+                return json.loads(s)
+    except ImportError:
+        def dumpb(obj):
+            return _json_encode(obj).encode('utf-8')
+
+        loads = json.loads
+
+# Bound once at import; called for every record written.
+_time = time.time
+
+def _byte_writer(stream):
+    """
+    @brief Returns a function that writes UTF-8 bytes to a text stream.
+
+    Bytes are written straight to the stream's binary buffer when it has
+    one, which skips the encoding step; otherwise they are decoded and
+    written as text.
+
+    @param stream The text stream to write to.
+    @return The write function.
+    """
+    buffer = getattr(stream, 'buffer', None)
+    if buffer is None:
+        return lambda data: stream.write(data.decode('utf-8'))
+    # Anything already written as text has to reach the buffer first.
+    stream.flush()
+    return buffer.write
+
+class _ListSink(io.TextIOBase):
+    """
+    @brief A write-only text stream that collects writes in a list.
+
+    Test output is captured by replacing sys.stdout with a sink. Appending
+    to a list avoids re-growing a single buffer on every write; the pieces
+    are only joined when the output is read. Like StringIO, only str can be
+    written, and the sink has no file descriptor.
+    """
+
+    def __init__(self):
+        super(_ListSink, self).__init__()
+        self.parts = []
+
+    def write(self, s):
+        """
+        @brief Writes a string to the sink.
+
+        @param s The string to write.
+        @return The number of characters written.
+        """
+        if not isinstance(s, str):
+            raise TypeError('string argument expected, got %r' % type(s).__name__)
+        self.parts.append(s)
+        return len(s)
+
+    def writelines(self, lines):
+        """
+        @brief Writes a sequence of strings to the sink.
+
+        @param lines The strings to write.
+        """
+        for line in lines:
+            self.write(line)
+
+    def writable(self):
+        """
+        @brief Reports that the sink can be written to.
+
+        @return True.
+        """
+        return True
+
+    def flush(self):
+        """
+        @brief Does nothing; writes are never buffered.
+        """
+
+    def clear(self):
+        """
+        @brief Discards everything written so far, keeping the sink for reuse.
+        """
+        del self.parts[:]
+
+    def isatty(self):
+        """
+        @brief Reports that the sink isn't a terminal.
+
+        @return False.
+        """
+        return False
+
+    def getvalue(self):
+        """
+        @brief Returns everything written to the sink so far.
+        """
+        return ''.join(self.parts)
+
+
 class PipedTestResult(unittest.result.TestResult):
     """
     @brief A test result class that can print test results in a machine-parseable format.
     """
     RESULT_SEPARATOR = '\x1f'  # ASCII US (Unit Separator)
+    _SEPARATOR_LINE = (RESULT_SEPARATOR + '\n').encode('ascii')
 
     def __init__(self, stream, use_old_discovery=True):
         """
@@ -31,11 +167,14 @@ class PipedTestResult(unittest.result.TestResult):
         """
         super(PipedTestResult, self).__init__()
         self.stream = stream
+        self._write = _byte_writer(stream)
         self.use_old_discovery = use_old_discovery
         self._first = True
 
-        # Create a clean buffer for stdout content.
-        self._stdout = StringIO()
+        # Create a clean buffer for stdout content. The same buffer is
+        # cleared and reused for every test; tests are run one at a time,
+        # so it is never shared between two running tests.
+        self._stdout = _ListSink()
         sys.stdout = self._stdout
         self._current_test = None
 
@@ -64,6 +203,42 @@ class PipedTestResult(unittest.result.TestResult):
         # Return a single string:
         return '\n'.join(trimmed)
 
+    def _emit(self, body):
+        """
+        @brief Writes a single result record to the stream, without flushing it.
+
+        @param body The result record.
+        """
+        self._write(dumpb(body) + b'\n')
+
+    def _format_error(self, err):
+        """
+        @brief Formats an exception as a traceback string.
+
+        @param err The (type, value, traceback) tuple of the exception.
+        @return The formatted traceback.
+        """
+        # format_exception() returns lines that already end in a newline.
+        return ''.join(traceback.format_exception(*err))
+
+    def _write_result(self, test, status, error=None):
+        """
+        @brief Writes the result record for a finished test or subtest.
+
+        @param test The test case.
+        @param status The protocol status code of the result.
+        @param error The error text, if the result has one.
+        """
+        body = {
+            'status': status,
+            'end_time': _time(),
+            'description': self.description(test),
+        }
+        if error is not None:
+            body['error'] = error
+        body['output'] = self._stdout.getvalue()
+        self._emit(body)
+
     def description(self, test):
         """
         @brief Provides a description for a test.
@@ -81,6 +256,20 @@ class PipedTestResult(unittest.result.TestResult):
             else:
                 return 'No description'
 
+    def _test_path(self, test):
+        """
+        @brief Works out the path that identifies a test to the GUI.
+
+        @param test The test case.
+        @return The test path.
+        """
+        test_id = test.id()
+        if not self.use_old_discovery:
+            return test_id
+        parts = test_id.split('.')
+        tests_index = parts.index('tests')
+        return '%s.%s.%s' % (parts[tests_index - 1], parts[-2], parts[-1])
+
     def startTest(self, test):
         """
         @brief Called when a test is started.
@@ -90,26 +279,31 @@ class PipedTestResult(unittest.result.TestResult):
         super(PipedTestResult, self).startTest(test)
         # We know we're starting a new test - record it.
         self._current_test = test
-        self._stdout = StringIO()
+        self._stdout.clear()
         sys.stdout = self._stdout
 
-        if self.use_old_discovery:
-            parts = test.id().split('.')
-            tests_index = parts.index('tests')
-            path = '%s.%s.%s' % (parts[tests_index - 1], parts[-2], parts[-1])
-        else:
-            path = test.id()
-
         body = {
-            'path': path,
-            'start_time': time.time()
+            'path': self._test_path(test),
+            'start_time': _time()
         }
         if self._first:
-            self.stream.write(PipedTestRunner.START_TEST_RESULTS + '\n')
+            self._write(PipedTestRunner._START_LINE)
             self._first = False
         else:
-            self.stream.write(self.RESULT_SEPARATOR + '\n')
-        self.stream.write('%s\n' % json.dumps(body))
+            self._write(self._SEPARATOR_LINE)
+        self._emit(body)
+        # Flush now so the GUI can show which test is running.
+        self.stream.flush()
+
+    def stopTest(self, test):
+        """
+        @brief Called when a test has finished, after its result has been recorded.
+
+        @param test The test case.
+        """
+        super(PipedTestResult, self).stopTest(test)
+        # All records for this test (including any subtests) have been
+        # written; pass them on to the reader in one go.
         self.stream.flush()
 
     def addSuccess(self, test):
@@ -119,14 +313,7 @@ class PipedTestResult(unittest.result.TestResult):
         @param test The test case.
         """
         super(PipedTestResult, self).addSuccess(test)
-        body = {
-            'status': 'OK',
-            'end_time': time.time(),
-            'description': self.description(test),
-            'output': self._stdout.getvalue(),
-        }
-        self.stream.write('%s\n' % json.dumps(body))
-        self.stream.flush()
+        self._write_result(test, 'OK')
         self._current_test = None
 
     def addError(self, test, err):
@@ -142,15 +329,7 @@ class PipedTestResult(unittest.result.TestResult):
             self.startTest(test)
 
         super(PipedTestResult, self).addError(test, err)
-        body = {
-            'status': 'E',
-            'end_time': time.time(),
-            'description': self.description(test),
-            'error': '\n'.join(traceback.format_exception(*err)),
-            'output': self._stdout.getvalue(),
-        }
-        self.stream.write('%s\n' % json.dumps(body))
-        self.stream.flush()
+        self._write_result(test, 'E', self._format_error(err))
         self._current_test = None
 
     def addFailure(self, test, err):
@@ -161,15 +340,7 @@ class PipedTestResult(unittest.result.TestResult):
         @param err The exception raised.
         """
         super(PipedTestResult, self).addFailure(test, err)
-        body = {
-            'status': 'F',
-            'end_time': time.time(),
-            'description': self.description(test),
-            'error': '\n'.join(traceback.format_exception(*err)),
-            'output': self._stdout.getvalue(),
-        }
-        self.stream.write('%s\n' % json.dumps(body))
-        self.stream.flush()
+        self._write_result(test, 'F', self._format_error(err))
         self._current_test = None
 
     def addSubTest(self, test, subtest, err):
@@ -182,34 +353,11 @@ class PipedTestResult(unittest.result.TestResult):
         """
         super(PipedTestResult, self).addSubTest(test, subtest, err)
         if err is None:
-            body = {
-                'status': 'OK',
-                'end_time': time.time(),
-                'description': self.description(test),
-                'output': self._stdout.getvalue(),
-            }
-            self.stream.write('%s\n' % json.dumps(body))
-            self.stream.flush()
+            self._write_result(test, 'OK')
         elif issubclass(err[0], test.failureException):
-            body = {
-                'status': 'F',
-                'end_time': time.time(),
-                'description': self.description(test),
-                'error': '\n'.join(traceback.format_exception(*err)),
-                'output': self._stdout.getvalue(),
-            }
-            self.stream.write('%s\n' % json.dumps(body))
-            self.stream.flush()
+            self._write_result(test, 'F', self._format_error(err))
         else:
-            body = {
-                'status': 'E',
-                'end_time': time.time(),
-                'description': self.description(test),
-                'error': '\n'.join(traceback.format_exception(*err)),
-                'output': self._stdout.getvalue(),
-            }
-            self.stream.write('%s\n' % json.dumps(body))
-            self.stream.flush()
+            self._write_result(test, 'E', self._format_error(err))
 
     def addSkip(self, test, reason):
         """
@@ -219,15 +367,7 @@ class PipedTestResult(unittest.result.TestResult):
         @param reason The reason for skipping.
         """
         super(PipedTestResult, self).addSkip(test, reason)
-        body = {
-            'status': 's',
-            'end_time': time.time(),
-            'description': self.description(test),
-            'error': reason,
-            'output': self._stdout.getvalue(),
-        }
-        self.stream.write('%s\n' % json.dumps(body))
-        self.stream.flush()
+        self._write_result(test, 's', reason)
         self._current_test = None
 
     def addExpectedFailure(self, test, err):
@@ -238,15 +378,7 @@ class PipedTestResult(unittest.result.TestResult):
         @param err The exception raised.
         """
         super(PipedTestResult, self).addExpectedFailure(test, err)
-        body = {
-            'status': 'x',
-            'end_time': time.time(),
-            'description': self.description(test),
-            'error': '\n'.join(traceback.format_exception(*err)),
-            'output': self._stdout.getvalue(),
-        }
-        self.stream.write('%s\n' % json.dumps(body))
-        self.stream.flush()
+        self._write_result(test, 'x', self._format_error(err))
         self._current_test = None
 
     def addUnexpectedSuccess(self, test):
@@ -256,14 +388,7 @@ class PipedTestResult(unittest.result.TestResult):
         @param test The test case.
         """
         super(PipedTestResult, self).addUnexpectedSuccess(test)
-        body = {
-            'status': 'u',
-            'end_time': time.time(),
-            'description': self.description(test),
-            'output': self._stdout.getvalue(),
-        }
-        self.stream.write('%s\n' % json.dumps(body))
-        self.stream.flush()
+        self._write_result(test, 'u')
         self._current_test = None
 
 class PipedTestRunner(unittest.TextTestRunner):
@@ -272,6 +397,8 @@ class PipedTestRunner(unittest.TextTestRunner):
     """
     START_TEST_RESULTS = '\x02'  # ASCII STX (Start of Text)
     END_TEST_RESULTS = '\x03'    # ASCII ETX (End of Text)
+    _START_LINE = (START_TEST_RESULTS + '\n').encode('ascii')
+    _END_LINE = (END_TEST_RESULTS + '\n').encode('ascii')
 
     def __init__(self, stream=sys.stdout, use_old_discovery=False):
         """
@@ -298,7 +425,7 @@ class PipedTestRunner(unittest.TextTestRunner):
         test(result)
 
         # Report end of test run
-        self.stream.write(self.END_TEST_RESULTS + '\n')
+        _byte_writer(self.stream)(self._END_LINE)
         self.stream.flush()
 
         # Restore the stdout reference
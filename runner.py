@@ -5,34 +5,131 @@ This module provides functionalities to execute test cases, manage their outputs
 and parse the results using subprocesses and threading.
 """
 
-import json
+import os
+import re
 import subprocess
-import sys
+from bisect import bisect_left
+from collections import defaultdict, deque
 from threading import Thread
 
-try:
-    from Queue import Queue, Empty
-except ImportError:
-    from queue import Queue, Empty  # python 3.x
-
 from events import EventSource
 from model import TestMethod
 import pipes
 
+# The lines of the result protocol that separate test results; each is a
+# single control character.
+_SEPARATORS = frozenset((
+    pipes.PipedTestResult.RESULT_SEPARATOR,
+    pipes.PipedTestRunner.START_TEST_RESULTS,
+    pipes.PipedTestRunner.END_TEST_RESULTS,
+))
+
+# Leading terminal escape sequences: control sequences (ESC [ ...) and the
+# other two-character and intermediate-byte escapes.
+_ANSI_RE = re.compile(r'^(?:\x1b\[[0-?]*[ -/]*[@-~]|\x1b[ -/]*[0-~])+')
+
+# How to describe the time left in a run. A time of up to _REMAINING_BOUNDS[i]
+# seconds is shown using _REMAINING_FORMATS[i], as (seconds per unit, format);
+# anything longer uses the last format.
+_REMAINING_BOUNDS = [60, 120, 3600, 7200]
+_REMAINING_FORMATS = [
+    (1, '%ds'),
+    (60, '%d min'),
+    (60, '%d mins'),
+    (3600, '%d hour'),
+    (3600, '%d hours'),
+]
+
+# The estimate of time left in a run is only remade every
+# (test count / _ESTIMATE_STEPS) tests, or once it is _ESTIMATE_INTERVAL
+# seconds old; in between, the last estimate is reported again.
+_ESTIMATE_STEPS = 200
+_ESTIMATE_INTERVAL = 0.1
+
+# Whether to close inherited file descriptors in the test subprocess.
+_CLOSE_FDS = (os.name == 'posix')
+
+# The characters stripped from each line of output; the same set that
+# bytes.strip() removes, as str.strip() would also remove unicode whitespace.
+_WHITESPACE = ' \t\n\r\x0b\x0c'
+
+
+def parse_record(line):
+    """! Parse the result record held in a line of test output.
+
+    @param line The line of output
+    @return The parsed record, or None if the line doesn't hold one
+    @details Doctest (and some other tools) output invisible escape sequences;
+             these are stripped before parsing.
+    """
+    if line.startswith('\x1b'):
+        line = _ANSI_RE.sub('', line, count=1)
+    if line.startswith('{'):
+        try:
+            return pipes.loads(line)
+        except ValueError:
+            pass
+    return None
 
-def enqueue_output(out, queue):
+
+def enqueue_output(out, queue, parse=False):
     """! A utility method for consuming piped output from a subprocess.
 
     @param out The output stream to read from
-    @param queue The queue to put the output lines into
-    @details Reads content from `out` one line at a time, and puts it onto
-             queue for consumption in a separate thread.
+    @param queue The deque to append the output lines to
+    @param parse If True, append (line, record) pairs instead of lines, where
+                 record is the result of parse_record() for the line
+    @details Reads content from `out` in large blocks, splits it into lines,
+             and appends them to queue for consumption in a separate thread.
+             Each block's complete lines are decoded in one go; a trailing
+             partial line is kept until the rest of it has been read.
+             Parsing records here keeps that work off the GUI thread.
     """
-    for line in iter(out.readline, b''):
-        queue.put(line.strip().decode('utf-8'))
+    def put(lines):
+        lines = [line.strip(_WHITESPACE) for line in lines]
+        if parse:
+            lines = [(line, parse_record(line)) for line in lines]
+        queue.extend(lines)
+
+    fd = out.fileno()
+    pending = bytearray()
+    while True:
+        block = os.read(fd, 65536)
+        if not block:
+            break
+        pending += block
+        end = pending.rfind(b'\n') + 1
+        if end:
+            put(pending[:end].decode('utf-8').split('\n')[:-1])
+            del pending[:end]
+    if pending:
+        put([pending.decode('utf-8')])
     out.close()
 
 
+def drain_queue(queue):
+    """! Remove and return everything currently in a queue, without blocking.
+
+    @param queue The deque to drain
+    @return A list of the items that were in the queue, oldest first
+    @details Only the items present when the call starts are removed; anything
+             appended meanwhile by the reader thread is left for the next call.
+             Appending and popping are atomic on a deque, so no lock is needed
+             as long as there is a single consumer.
+    """
+    return [queue.popleft() for _ in range(len(queue))]
+
+
+def format_remaining_time(remaining_time):
+    """! Describe an estimated time left in a run.
+
+    @param remaining_time The time left, in seconds
+    @return A short description, such as '40s' or '3 mins'
+    """
+    unit, fmt = _REMAINING_FORMATS[bisect_left(_REMAINING_BOUNDS, remaining_time)]
+    return fmt % (remaining_time // unit)
+
+
 def parse_status_and_error(post):
     """! Parse the status and error information from the test result.
 
@@ -83,19 +180,19 @@ class Runner(EventSource):
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             shell=False,
-            bufsize=1,
-            close_fds='posix' in sys.builtin_module_names
+            bufsize=-1,
+            close_fds=_CLOSE_FDS
         )
 
         # Piped stdout/stderr reads are blocking; therefore, we need to
-        # do all our readline calls in a background thread, and use a
-        # queue object to store lines that have been read.
-        self.stdout = Queue()
-        t = Thread(target=enqueue_output, args=(self.proc.stdout, self.stdout))
+        # do all our reads in a background thread, and use a
+        # deque to store lines that have been read.
+        self.stdout = deque()
+        t = Thread(target=enqueue_output, args=(self.proc.stdout, self.stdout, True))
         t.daemon = True
         t.start()
 
-        self.stderr = Queue()
+        self.stderr = deque()
         t = Thread(target=enqueue_output, args=(self.proc.stderr, self.stderr))
         t.daemon = True
         t.start()
@@ -123,6 +220,13 @@ class Runner(EventSource):
         # The count of specific test results.
         self.result_count = {}
 
+        # The last estimate of how long the suite has left to run, the end
+        # time of the test it was made at, and how many tests apart
+        # estimates are made.
+        self.remaining = None
+        self._estimate_time = None
+        self._estimate_every = max(1, count // _ESTIMATE_STEPS)
+
     @property
     def is_running(self):
         """! Check if the runner is currently running.
@@ -152,24 +256,11 @@ class Runner(EventSource):
         stopped = False
         finished = False
 
-        # Read from stdout, building a buffer.
-        lines = []
-        try:
-            while True:
-                lines.append(self.stdout.get(block=False))
-        except Empty:
-            # queue.get() raises an exception when the queue is empty.
-            # This means there is no more output to consume at this time.
-            pass
+        # Read from stdout, building a buffer of (line, record) pairs.
+        lines = drain_queue(self.stdout)
 
         # Read from stderr, building a buffer.
-        try:
-            while True:
-                self.error_buffer.append(self.stderr.get(block=False))
-        except Empty:
-            # queue.get() raises an exception when the queue is empty.
-            # This means there is no more output to consume at this time.
-            pass
+        self.error_buffer.extend(drain_queue(self.stderr))
 
         # Check to see if the subprocess is still running.
         # If it isn't, raise an error.
@@ -179,31 +270,27 @@ class Runner(EventSource):
             stopped = True
 
         # Process all the full lines that are available
-        for line in lines:
-            # Look for a separator.
-            if line in (
-                pipes.PipedTestResult.RESULT_SEPARATOR,
-                pipes.PipedTestRunner.START_TEST_RESULTS,
-                pipes.PipedTestRunner.END_TEST_RESULTS
-            ):
+        for line, record in lines:
+            # Look for a separator. Checking the length first means
+            # content lines never need to be hashed.
+            if len(line) == 1 and line in _SEPARATORS:
                 if self.buffer is None:
                     # Preamble is finished. Set up the line buffer.
                     self.buffer = []
                 else:
                     # Start of new test result; record the last result
                     # Then, work out what content goes where.
-                    pre = json.loads(self.buffer[0])
+                    pre = self.buffer[0]
                     if len(self.buffer) == 2:
                         # No subtests are present, or only one subtest
-                        post = json.loads(self.buffer[1])
+                        post = self.buffer[1]
                         status, error = parse_status_and_error(post)
 
                     else:
                         # We have subtests; capture the most important status (until we can capture all the statuses)
                         status = TestMethod.STATUS_PASS  # Assume pass until told otherwise
                         error = ''
-                        for line_num in range(1, len(self.buffer)):
-                            post = json.loads(self.buffer[line_num])
+                        for post in self.buffer[1:]:
                             subtest_status, subtest_error = parse_status_and_error(post)
                             if subtest_status > status:
                                 status = subtest_status
@@ -217,38 +304,32 @@ class Runner(EventSource):
                     start_time = float(pre['start_time'])
                     end_time = float(post['end_time'])
 
-                    self.current_test.description = post['description']
-
                     self.current_test.set_result(
                         status=status,
                         output=post.get('output'),
                         error=error,
                         duration=end_time - start_time,
+                        description=post['description'],
                     )
 
                     # Work out how long the suite has left to run (approximately)
                     if self.start_time is None:
                         self.start_time = start_time
-                    total_duration = end_time - self.start_time
-                    time_per_test = total_duration / self.completed_count
-                    remaining_time = (self.total_count - self.completed_count) * time_per_test
-                    if remaining_time > 4800:
-                        remaining = '%s hours' % int(remaining_time / 2400)
-                    elif remaining_time > 2400:
-                        remaining = '%s hour' % int(remaining_time / 2400)
-                    elif remaining_time > 120:
-                        remaining = '%s mins' % int(remaining_time / 60)
-                    elif remaining_time > 60:
-                        remaining = '%s min' % int(remaining_time / 60)
-                    else:
-                        remaining = '%ss' % int(remaining_time)
+                    if (self._estimate_time is None
+                            or self.completed_count % self._estimate_every == 0
+                            or end_time - self._estimate_time >= _ESTIMATE_INTERVAL):
+                        total_duration = end_time - self.start_time
+                        time_per_test = total_duration / self.completed_count
+                        remaining_time = (self.total_count - self.completed_count) * time_per_test
+                        self.remaining = format_remaining_time(remaining_time)
+                        self._estimate_time = end_time
 
                     # Update test result counts
                     self.result_count.setdefault(status, 0)
                     self.result_count[status] = self.result_count[status] + 1
 
                     # Notify the display to update.
-                    self.emit('test_end', test_path=self.current_test.path, result=status, remaining_time=remaining)
+                    self.emit('test_end', test_path=self.current_test.path, result=status, remaining_time=self.remaining)
 
                     # Clear the decks for the next test.
                     self.current_test = None
@@ -269,25 +350,20 @@ class Runner(EventSource):
                     self.emit('test_status_update', update=line)
                 else:
                     # Suite is running - have we got an active test?
-                    # Doctest (and some other tools) output invisible escape sequences.
-                    # Strip these if they exist.
-                    if line.startswith('\x1b'):
-                        line = line[line.find('{'):]
-
-                    # Store the cleaned buffer
-                    self.buffer.append(line)
-
-                    # If we don't have an currently active test, this line will
+                    # The record was parsed by the reader thread.
+                    if record is None:
+                        if self.current_test is not None:
+                            raise ValueError('Unexpected test output: %r' % line)
+                        self.emit('suit_end')
+                        return True
+                    self.buffer.append(record)
+
+                    # If we don't have an currently active test, this record will
                     # contain the path for the test.
                     if self.current_test is None:
-                        try:
-                            # No active test; first line tells us which test is running.
-                            pre = json.loads(line)
-                        except ValueError:
-                            self.emit('suit_end')
-                            return True
-                        self.current_test = self.project.confirm_exists(pre['path'])
-                        self.emit('test_start', test_path=pre['path'])
+                        # No active test; first record tells us which test is running.
+                        self.current_test = self.project.confirm_exists(record['path'])
+                        self.emit('test_start', test_path=record['path'])
         # If we're not finished, requeue the event.
         if finished:
             if self.error_buffer:
@@ -335,13 +411,15 @@ class PyTestExecutor(object):
         @param iterable The iterable containing nested test results
         @return A generator yielding flattened test results
         """
-        input = list(iterable)
-        while input:
-            item = input.pop(0)
-            try:
-                data = iter(item)
-                input = list(data) + input
-            except:
+        # Walk the suites depth-first with an explicit stack, kept in
+        # reverse so that tests come out in their original order.
+        stack = list(iterable)
+        stack.reverse()
+        while stack:
+            item = stack.pop()
+            if isinstance(item, unittest.BaseTestSuite):
+                stack.extend(reversed(list(item)))
+            else:
                 yield item
 
     def run_only(self, specified_list):
@@ -369,34 +447,33 @@ class PyTestExecutor(object):
 
         loader = unittest.TestLoader()
         tests = loader.discover(testdir)
-        flat_tests = list(self.flatten_results(tests))
 
         if not self.specified_list:
-            suite = loader.discover(testdir)
-            self.stream_suite(suite)
+            self.stream_suite(tests)
         else:
             suite = unittest.TestSuite()
-
-            # Add individual test cases.
-            for test in flat_tests:
-                if test.id() in self.specified_list:
+            specified_set = set(self.specified_list)
+
+            # Index the discovered tests by file and by class, in a single
+            # pass; add individual test cases as we go.
+            by_module = defaultdict(list)
+            by_class = defaultdict(list)
+            for test in self.flatten_results(tests):
+                test_id = test.id()
+                if test_id in specified_set:
                     suite.addTest(test)
+                by_module[test_id.split('.', 1)[0]].append(test)
+                by_class[test_id.rpartition('.')[0]].append(test)
 
             # Add all tests in a file.
             for specified in self.specified_list:
                 if specified.count('.') == 0:
-                    for test in flat_tests:
-                        module_name = test.id()[0:test.id().index('.')]
-                        if specified == module_name:
-                            suite.addTest(test)
+                    suite.addTests(by_module.get(specified, ()))
 
             # Add all tests in a class within a file.
             for specified in self.specified_list:
                 if specified.count('.') == 1:
-                    for test in flat_tests:
-                        module_name = test.id()[0:test.id().rindex('.')]
-                        if specified == module_name:
-                            suite.addTest(test)
+                    suite.addTests(by_class.get(specified, ()))
 
             self.stream_suite(suite)
 
@@ -696,7 +696,7 @@ class MainWindow(object):
 
             if testMethod._result:
                 # Test has been executed
-                self.duration.set('%0.2fs' % testMethod._result['duration'])
+                self.duration.set('%0.2fs' % testMethod.duration)
 
                 if testMethod.output:
                     self._show_test_output(testMethod.output)